@@ -1,41 +1,222 @@
 import streamlit as st
 import numpy as np
-import pandas as pd
 import hashlib
-from statsmodels.stats.proportion import proportions_ztest, proportion_effectsize
-from statsmodels.stats.power import NormalIndPower
+from scipy.special import betaln
 import math
+from numpy.random import default_rng
+
+try:
+    from xxhash import xxh3_64_intdigest
+except ImportError:
+    xxh3_64_intdigest = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # --- 页面设置 ---
 st.set_page_config(page_title="AB实验全功能教学沙盘", layout="wide")
 
+# 共用的随机数生成器 (PCG64)：用于贝叶斯后验采样与 AA 自检的点击模拟
+_rng = default_rng()
+
+
+# --- 核心哈希分流算法（批量向量化） ---
+# 分流只要求哈希均匀，不需要密码学强度：优先使用更快的 xxh3，未安装 xxhash 时回退到 MD5
+def assign_groups(n, id_prefix, layer_name, salt):
+    """
+    对 n 个用户批量分流，返回布尔掩码：True 表示 B 组
+    第 i 个用户的哈希键为 f"{id_prefix}{i}_{layer_name}_{salt}" 的 UTF-8 编码，
+    哈希值取 xxh3_64 整数，或 MD5 摘要按大端读成的 128 位整数；哈希值 % 100 < 50 为 A 组，否则为 B 组
+    """
+    # 用户 ID 只有中间的序号在变：预先编码成 bytes 模板，每个用户只做一次整数格式化
+    prefix = id_prefix.encode().replace(b"%", b"%%")
+    suffix = f"_{layer_name}_{salt}".encode().replace(b"%", b"%%")
+    template = prefix + b"%d" + suffix
+    keys = [template % i for i in range(n)]
+    if xxh3_64_intdigest is not None:
+        bucket = np.fromiter(map(xxh3_64_intdigest, keys), dtype=np.uint64, count=n) % 100
+        return bucket >= 50
+
+    # 直接读取原始摘要字节，省去 hexdigest 的十六进制往返；取完整 128 位再取模，避免单字节取模的偏差
+    digests = [hashlib.md5(key).digest() for key in keys]
+    # 把 128 位摘要按大端读成高低两个 uint64：(hi * 2^64 + lo) % 100，其中 2^64 % 100 == 16
+    words = np.frombuffer(b"".join(digests), dtype='>u8').reshape(n, 2)
+    bucket = (words[:, 0] % 100 * 16 + words[:, 1] % 100) % 100
+    return bucket >= 50
+
+
+# --- 频率派：两比例 z 检验 (合并方差，双侧) ---
+def ztest_2prop(s1, n1, s2, n2):
+    # 任一组没有样本时无法检验，视为无差异
+    if n1 == 0 or n2 == 0:
+        return 0.0, 1.0
+    p1, p2 = s1 / n1, s2 / n2
+    p_pool = (s1 + s2) / (n1 + n2)
+    se = math.sqrt(p_pool * (1 - p_pool) * (1 / n1 + 1 / n2))
+    if se == 0:
+        return 0.0, 1.0
+    z = (p1 - p2) / se
+    return z, math.erfc(abs(z) / math.sqrt(2))
+
+
+# --- 分组 → 点击 → 计数 融合为一次遍历，不再生成逐用户的概率与点击数组 ---
+# 哈希仍在 assign_groups 中完成：MD5/xxh3 无法在 Numba 内使用，换用其他哈希会改变分流结果
+if njit is not None:
+    @njit(cache=True)
+    def _count_kernel(is_b, u, p_a, p_b):
+        ca_n = ca_s = cb_n = cb_s = 0
+        for i in range(is_b.shape[0]):
+            if is_b[i]:
+                cb_n += 1
+                if u[i] < p_b:
+                    cb_s += 1
+            else:
+                ca_n += 1
+                if u[i] < p_a:
+                    ca_s += 1
+        return ca_n, ca_s, cb_n, cb_s
+else:
+    _count_kernel = None
+
+
+def count_clicks(is_b, u, p_a, p_b):
+    """
+    用均匀随机数 u 判定每个用户是否点击，返回 (ca_n, ca_s, cb_n, cb_s)
+    """
+    if _count_kernel is not None:
+        return tuple(int(x) for x in _count_kernel(is_b, u, p_a, p_b))
+
+    # 未安装 Numba 时按组切出均匀数直接与各自转化率比较，不构造逐用户的概率数组与点击数组
+    cb_n = int(np.count_nonzero(is_b))
+    cb_s = int(np.count_nonzero(u[is_b] < p_b))
+    ca_s = int(np.count_nonzero(u[~is_b] < p_a))
+    return len(is_b) - cb_n, ca_s, cb_n, cb_s
+
+
+# --- 核心算法：AB 数据模拟 (按参数缓存) ---
+@st.cache_data
+def simulate_ab(current_n, base_p, salt_1, true_lift, seed):
+    """
+    模拟 current_n 个用户的分流与点击，返回两组的样本量、点击数及频率派结果
+    固定 seed 使同一组参数的结果稳定，可直接命中缓存
+    """
+    rng = np.random.default_rng(seed)
+    is_b = assign_groups(current_n, "user_", "L1", salt_1)
+    # 均匀数只用于和转化率比较，float32 精度足够，内存与带宽减半
+    u = rng.random(current_n, dtype=np.float32)
+    ca_n, ca_s, cb_n, cb_s = count_clicks(is_b, u, base_p, base_p * (1 + true_lift))
+
+    z, p_val = ztest_2prop(cb_s, cb_n, ca_s, ca_n)
+    # A 组无点击 (或 B 组无样本) 时提升率无定义，返回 nan 由看板显示为 “—”
+    if ca_s == 0 or cb_n == 0:
+        obs_lift = float('nan')
+    else:
+        obs_lift = (cb_s / cb_n) / (ca_s / ca_n) - 1
+    return {"ca_n": ca_n, "ca_s": ca_s, "cb_n": cb_n, "cb_s": cb_s,
+            "p_val": p_val, "obs_lift": obs_lift}
+
+
+# --- 功效计算 (statsmodels 求根较慢，按参数缓存) ---
+# statsmodels 导入耗时较长，放到函数内按需导入，避免拖慢页面冷启动
+# 实验设计只取决于 (base_p, mde_target)，拖动运行天数时直接命中缓存
+@st.cache_data
+def compute_design(base_p, mde_target):
+    from statsmodels.stats.power import NormalIndPower
+    from statsmodels.stats.proportion import proportion_effectsize
 
-# --- 核心哈希分流算法 ---
-def get_group(user_id, layer_name, salt):
-    input_str = f"{user_id}_{layer_name}_{salt}"
-    hash_val = int(hashlib.md5(input_str.encode()).hexdigest(), 16)
-    return 'A' if (hash_val % 100) < 50 else 'B'
+    p2_mde = base_p * (1 + mde_target)
+    es = proportion_effectsize(p2_mde, base_p)
+    req_n_per_group = NormalIndPower().solve_power(effect_size=es, alpha=0.05, power=0.8, ratio=1.0)
+    return es, math.ceil(req_n_per_group * 2)
+
+
+@st.cache_data
+def compute_power(es, nobs1):
+    from statsmodels.stats.power import NormalIndPower
+
+    raw_p = NormalIndPower().power(effect_size=es, nobs1=nobs1, alpha=0.05, ratio=1.0)
+    return float(raw_p.power) if hasattr(raw_p, 'power') else float(raw_p)
 
 
 # --- 核心算法：贝叶斯分析 ---
+def prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b):
+    """
+    Beta 后验下 P(pB > pA) 的闭式解 (Evan Miller 公式)
+    对 alpha_b 项求和，要求 alpha_b 为整数；在对数空间累加保证数值稳定
+    """
+    i = np.arange(alpha_b)
+    log_terms = (betaln(alpha_a + i, beta_a + beta_b) - np.log(beta_b + i)
+                 - betaln(1 + i, beta_b) - betaln(alpha_a, beta_a))
+    return float(np.exp(np.logaddexp.reduce(log_terms)))
+
+
+# --- 可选加速：Numba 将采样、比较与求和融合为一次循环 ---
+# numba 不在 requirements.txt 中，默认安装走下方的 NumPy 采样；仅在手动安装 numba 后启用
+# 样本量固定且不大，不开 parallel，避免首次调用时并行内核的编译开销
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _bayes_kernel(alpha_a, beta_a, alpha_b, beta_b, samples):
+        wins = 0.0
+        loss = 0.0
+        for _ in range(samples):
+            a = np.random.beta(alpha_a, beta_a)
+            b = np.random.beta(alpha_b, beta_b)
+            if b > a:
+                wins += 1.0
+            else:
+                loss += a - b
+        return wins / samples, loss / samples
+else:
+    _bayes_kernel = None
+
+
+@st.cache_data(max_entries=128)
 def run_bayesian_analysis(c_clicks, c_n, t_clicks, t_n):
     """
-    使用 Beta 分布进行贝叶斯后验采样
     计算 B 组优于 A 组的概率以及期望损失
+    点击数不大时用闭式解精确求值，否则退回 Beta 分布后验采样
     """
     # 采用无信息先验 Beta(1,1)
     alpha_a, beta_a = 1 + c_clicks, 1 + c_n - c_clicks
     alpha_b, beta_b = 1 + t_clicks, 1 + t_n - t_clicks
 
-    # 抽取 20,000 个样本模拟后验分布
+    # 两组后验均值相差超过 5 个后验标准差时结论已无悬念，用正态近似直接给出结果
+    # 使用后验均值与方差：方差恒为正，观测转化率为 0/1 或样本量为 0 时仍然有定义
+    mean_a = alpha_a / (alpha_a + beta_a)
+    mean_b = alpha_b / (alpha_b + beta_b)
+    var_a = alpha_a * beta_a / ((alpha_a + beta_a) ** 2 * (alpha_a + beta_a + 1))
+    var_b = alpha_b * beta_b / ((alpha_b + beta_b) ** 2 * (alpha_b + beta_b + 1))
+    z = (mean_b - mean_a) / math.sqrt(var_a + var_b)
+    if z > 5:
+        return 1.0, 0.0
+    if z < -5:
+        # B 几乎必输，期望损失即两组后验均值之差
+        return 0.0, max(mean_a - mean_b, 0.0)
+
+    # 闭式解的求和项数与 alpha_b 成正比，点击数过大时改用采样
+    if alpha_a + alpha_b < 10_000:
+        prob_b_better = prob_b_beats_a(alpha_a, beta_a, alpha_b, beta_b)
+        # 期望损失 E[max(pA - pB, 0)] = E[pA·1{pA>pB}] - E[pB·1{pA>pB}]
+        # 两项分别等于 A、B 的后验均值乘以参数 +1 后 A 胜出的概率
+        expected_loss = (mean_a * (1 - prob_b_beats_a(alpha_a + 1, beta_a, alpha_b, beta_b))
+                         - mean_b * (1 - prob_b_beats_a(alpha_a, beta_a, alpha_b + 1, beta_b)))
+        return prob_b_better, max(expected_loss, 0.0)
+
+    # 抽取 20,000 个样本模拟后验分布 (两组接近时期望损失的相对误差约 1%，样本减半会升到约 1.5%)
+    # 两组必须独立抽样：共用同一组均匀数 (公共随机数) 会让 pA、pB 完全正相关，P(B>A) 的估计随之有偏
     samples = 20000
-    a_samples = np.random.beta(alpha_a, beta_a, samples)
-    b_samples = np.random.beta(alpha_b, beta_b, samples)
+    if _bayes_kernel is not None:
+        return _bayes_kernel(float(alpha_a), float(beta_a), float(alpha_b), float(beta_b), samples)
+
+    a_samples = _rng.beta(alpha_a, beta_a, samples)
+    b_samples = _rng.beta(alpha_b, beta_b, samples)
 
     # 计算 B > A 的频率作为概率
-    prob_b_better = (b_samples > a_samples).mean()
+    prob_b_better = float((b_samples > a_samples).mean())
     # 计算期望损失：如果 B 实际比 A 差，选 B 平均会损失多少转化率
-    expected_loss = np.maximum(a_samples - b_samples, 0).mean()
+    expected_loss = float(np.maximum(a_samples - b_samples, 0).mean())
 
     return prob_b_better, expected_loss
 
@@ -66,12 +247,8 @@ st.markdown("""
 st.header("📅 第一阶段：排期预测 (Planning)")
 mde_target = st.slider("目标灵敏度 (MDE %)", 0.01, 0.15, 0.05)
 
-obj = NormalIndPower()
 try:
-    p2_mde = base_p * (1 + mde_target)
-    es = proportion_effectsize(p2_mde, base_p)
-    req_n_per_group = obj.solve_power(effect_size=es, alpha=0.05, power=0.8, ratio=1.0)
-    req_n = math.ceil(req_n_per_group * 2)
+    es, req_n = compute_design(base_p, mde_target)
     est_days = math.ceil(req_n / dau)
 
     col1, col2 = st.columns(2)
@@ -89,11 +266,10 @@ st.divider()
 st.header("🛡️ 第二阶段：AA 实验 (System Check)")
 if st.button("运行 AA 实验自检"):
     aa_n = min(req_n, 5000)
-    aa_users = [{"ID": f"u_{i}", "G": get_group(f"u_{i}", "L1", salt_1)} for i in range(aa_n)]
-    df_aa = pd.DataFrame(aa_users)
-    df_aa['C'] = df_aa['G'].apply(lambda x: np.random.binomial(1, base_p))
-    aa_res = df_aa.groupby('G')['C'].agg(['count', 'sum'])
-    z_aa, p_aa = proportions_ztest(aa_res['sum'][::-1], aa_res['count'][::-1])
+    is_b_aa = assign_groups(aa_n, "u_", "L1", salt_1)
+    # AA 实验两组真实转化率相同
+    aa_a_n, aa_a_s, aa_b_n, aa_b_s = count_clicks(is_b_aa, _rng.random(aa_n, dtype=np.float32), base_p, base_p)
+    z_aa, p_aa = ztest_2prop(aa_b_s, aa_b_n, aa_a_s, aa_a_n)
 
     if p_aa < 0.05:
         st.error(f"🚨 AA失败 (P={p_aa:.4f})：分流器不公平！此时结论不可信。")
@@ -106,25 +282,18 @@ st.header("📊 第三阶段：实时运行与双引擎决策")
 days_run = st.slider("实验已运行天数", 1, max(30, est_days + 7), min(7, est_days))
 current_n = dau * days_run
 
-# 数据模拟
-user_data = []
-for i in range(current_n):
-    uid = f"user_{i}"
-    g1 = get_group(uid, "L1", salt_1)
-    user_data.append({"ID": uid, "G": g1})
-df_ab = pd.DataFrame(user_data)
-df_ab['Click'] = df_ab['G'].apply(lambda x: np.random.binomial(1, base_p * (1 + true_lift) if x == 'B' else base_p))
-
-res = df_ab.groupby('G')['Click'].agg(['count', 'sum'])
-ca_n, ca_s = res.loc['A', 'count'], res.loc['A', 'sum']
-cb_n, cb_s = res.loc['B', 'count'], res.loc['B', 'sum']
+# 数据模拟：随机种子只由 Layer 1 盐值决定，修改 Layer 2 盐值不会影响本层结果
+sim_seed = int.from_bytes(hashlib.md5(salt_1.encode()).digest()[:8], 'big')
+sim = simulate_ab(current_n, base_p, salt_1, true_lift, sim_seed)
+ca_n, ca_s = sim["ca_n"], sim["ca_s"]
+cb_n, cb_s = sim["cb_n"], sim["cb_s"]
+p_val = sim["p_val"]
 
 # --- 核心：频率派 vs 贝叶斯 对比面板 ---
 st.subheader("⚖️ 决策博弈：谁更可信？")
 col_freq, col_bayes = st.columns(2)
 
 # 频率派计算
-z, p_val = proportions_ztest([cb_s, ca_s], [cb_n, ca_n])
 with col_freq:
     st.info("### 频率派 (Frequentist)")
     st.metric("P-value", f"{p_val:.4f}")
@@ -150,8 +319,7 @@ with col_bayes:
 st.divider()
 st.subheader("🛡️ 实验可信度质量审计")
 try:
-    raw_p = obj.power(effect_size=es, nobs1=current_n / 2, alpha=0.05, ratio=1.0)
-    curr_power = float(raw_p.power) if hasattr(raw_p, 'power') else float(raw_p)
+    curr_power = compute_power(es, current_n / 2)
 except:
     curr_power = 0.0
 
@@ -189,8 +357,11 @@ with aud2:
 # 指标看板
 st.divider()
 c1, c2, c3 = st.columns(3)
-obs_lift = (cb_s / cb_n) / (ca_s / ca_n) - 1
-c1.metric("观察到的提升", f"{obs_lift:.2%}", delta=f"{(obs_lift - true_lift):.2%} (偏离真值)")
+obs_lift = sim["obs_lift"]
+if math.isnan(obs_lift):
+    c1.metric("观察到的提升", "—")
+else:
+    c1.metric("观察到的提升", f"{obs_lift:.2%}", delta=f"{(obs_lift - true_lift):.2%} (偏离真值)")
 c2.metric("当前样本总量", f"{current_n:,}")
 c3.metric("统计功效 (Power)", f"{curr_power:.2%}")
 